@@ -1,21 +1,27 @@
 # -*- coding: utf-8 -*-
+import math
 import numpy as np
 import pandas as pd
 import matplotlib.pyplot as plt
 from scipy.signal import find_peaks
+import scipy.ndimage
 import scipy.signal
+import scipy.fft
 
 from ..signal import (signal_zerocrossings,
                       signal_resample,
                       signal_detrend,
-                      signal_smooth,
                       signal_filter,
-                      signal_findpeaks,
                       signal_formatpeaks)
 from .ecg_peaks import ecg_peaks
-from ..epochs import epochs_create
 from ..events import events_plot
 
+# PyWavelets is only required by the CWT method
+try:
+    import pywt
+except ImportError:
+    pywt = None
+
 
 def ecg_delineate(ecg_cleaned, rpeaks, sampling_rate=1000, method="derivative"):
     """Delineate QRS complex.
@@ -96,7 +102,8 @@ def ecg_delineate(ecg_cleaned, rpeaks, sampling_rate=1000, method="derivative"):
                                    sampling_rate=sampling_rate)
     # Remove NaN in Peaks, Onsets, and Offsets
     for feature in waves.keys():
-        waves[feature] = [x for x in waves[feature] if ~np.isnan(x)]
+        values = np.asarray(waves[feature], dtype=float)
+        waves[feature] = values[np.isfinite(values)].astype(int).tolist()
 
     instant_peaks = signal_formatpeaks(waves,
                                        desired_length=len(ecg_cleaned))
@@ -109,9 +116,8 @@ def ecg_delineate(ecg_cleaned, rpeaks, sampling_rate=1000, method="derivative"):
 ###############################################################################
 def _dwt_resample_points(peaks, sampling_rate, desired_sampling_rate):
     """Resample given points to a different sampling rate."""
-    peaks_resample = (np.array(peaks) * desired_sampling_rate / sampling_rate)
-    peaks_resample = peaks_resample[~np.isnan(peaks_resample)].astype(int)
-    return peaks_resample
+    peaks_resample = np.asarray(peaks, dtype=float) * desired_sampling_rate / sampling_rate
+    return peaks_resample[np.isfinite(peaks_resample)].astype(int)
 
 
 def _dwt_ecg_delinator(ecg, rpeaks, sampling_rate, analysis_sampling_rate=2000):
@@ -126,8 +132,16 @@ def _dwt_ecg_delinator(ecg, rpeaks, sampling_rate, analysis_sampling_rate=2000):
      Dictionary of the points.
 
     """
-    ecg = signal_resample(ecg, sampling_rate=sampling_rate, desired_sampling_rate=analysis_sampling_rate)
-    dwtmatr = _dwt_compute_multiscales(ecg, 9)
+    # No need to resample if the degrees of the transform can be compensated
+    # exactly, i.e., if the sampling rate is a power-of-two multiple of 250 Hz
+    if sampling_rate >= 250 and sampling_rate == 250 * 2 ** _dwt_compensate_degree(sampling_rate):
+        analysis_sampling_rate = sampling_rate
+        ecg = np.asarray(ecg)
+    else:
+        ecg = signal_resample(ecg, sampling_rate=sampling_rate, desired_sampling_rate=analysis_sampling_rate)
+
+    # Same scales as the 9 degrees computed at 2000 Hz
+    dwtmatr = _dwt_compute_multiscales(ecg, 6 + _dwt_compensate_degree(analysis_sampling_rate))
 
     # # only for debugging
     # for idx in [0, 1, 2, 3]:
@@ -162,7 +176,10 @@ def _dwt_ecg_delinator(ecg, rpeaks, sampling_rate, analysis_sampling_rate=2000):
 
 
 def _dwt_compensate_degree(sampling_rate):
-    return int(np.log2(sampling_rate / 250))
+    if sampling_rate >= 250:
+        # integer log2 of the ratio
+        return int(sampling_rate // 250).bit_length() - 1
+    return int(math.log2(sampling_rate / 250))
 
 
 def _dwt_delinate_tp_peaks(ecg, rpeaks, dwtmatr, sampling_rate=250, debug=False,
@@ -172,52 +189,58 @@ def _dwt_delinate_tp_peaks(ecg, rpeaks, dwtmatr, sampling_rate=250, debug=False,
                            epsilon_T_weight=0.25,
                            epsilon_P_weight=0.02):
     srch_bndry = int(0.9 * qrs_duration * sampling_rate / 2)
+    p_srch_duration = int(p_qrs_duration * sampling_rate)
     degree_add = _dwt_compensate_degree(sampling_rate)
-    peaks_dict = {
-        'tpeak': [], 'ppeak': []
-    }
+    tscale = dwtmatr[degree_tpeak + degree_add]
+    pscale = dwtmatr[degree_ppeak + degree_add]
+    rpeaks = np.asarray(rpeaks, dtype=int)
+    tpeaks = np.full(len(rpeaks) - 1, np.nan)
+    ppeaks = np.full(len(rpeaks) - 1, np.nan)
     for i in range(len(rpeaks)-1):
         for attribute in ['tpeak', 'ppeak']:
             if attribute == 'tpeak':
                 # search for T peaks from R peaks
                 srch_idx_start = rpeaks[i] + srch_bndry
                 srch_idx_end = rpeaks[i + 1] - srch_bndry * 8
-                dwt_local = dwtmatr[degree_tpeak + degree_add, srch_idx_start:srch_idx_end]
-                height = epsilon_T_weight * np.sqrt(np.mean(np.square(dwt_local)))
+                dwt_local = tscale[srch_idx_start:srch_idx_end]
+                height = epsilon_T_weight * np.linalg.norm(dwt_local) / math.sqrt(dwt_local.size)
             elif attribute == 'ppeak':
                 # search for P peaks from Rpeaks
-                srch_idx_start = rpeaks[i] - int(p_qrs_duration * sampling_rate)
+                srch_idx_start = rpeaks[i] - p_srch_duration
                 srch_idx_end = rpeaks[i] - srch_bndry
-                dwt_local = dwtmatr[degree_ppeak + degree_add, srch_idx_start:srch_idx_end]
-                height = epsilon_P_weight * np.sqrt(np.mean(np.square(dwt_local)))
+                dwt_local = pscale[srch_idx_start:srch_idx_end]
+                height = epsilon_P_weight * np.linalg.norm(dwt_local) / math.sqrt(dwt_local.size)
             if len(dwt_local) == 0:
-                peaks_dict[attribute].append(np.nan)
                 continue
 
-            peaks, peak_heights = scipy.signal.find_peaks(np.abs(dwt_local), height=height)
-            peaks = list(filter(lambda p: np.abs(dwt_local[p]) > 0.025 * max(dwt_local), peaks))
-            if dwt_local[0] > 0:  # just append
-                peaks = [0] + peaks
-
-            # detect morphology
-            candidate_peaks = []
-            for idx_peak, idx_peak_nxt in zip(peaks[:-1], peaks[1:]):
-                correct_sign = dwt_local[idx_peak] > 0 and dwt_local[idx_peak_nxt] < 0
-                if correct_sign:
-                    idx_zero = signal_zerocrossings(dwt_local[idx_peak: idx_peak_nxt])[0] + idx_peak
-                    candidate_peaks.append(idx_zero)
-
+            candidate_peaks = _dwt_delinate_tp_candidates(dwt_local, height)
             if len(candidate_peaks) == 0:
-                peaks_dict[attribute].append(np.nan)
                 continue
 
             # filtering? use a simple rule now
             if attribute == 'tpeak':
-                peaks_dict['tpeak'].append(candidate_peaks[0] + srch_idx_start)
+                tpeaks[i] = candidate_peaks[0] + srch_idx_start
             elif attribute == 'ppeak':
-                peaks_dict['ppeak'].append(candidate_peaks[-1] + srch_idx_start)
+                ppeaks[i] = candidate_peaks[-1] + srch_idx_start
+
+    return tpeaks, ppeaks
 
-    return peaks_dict['tpeak'], peaks_dict['ppeak']
+
+def _dwt_delinate_tp_candidates(dwt_local, height):
+    """Find the zero-crossings between positive-negative pairs of significant peaks of a transform window."""
+    peaks, _ = scipy.signal.find_peaks(np.abs(dwt_local), height=height)
+    peaks = peaks[np.abs(dwt_local[peaks]) > 0.025 * dwt_local.max()]
+    if dwt_local[0] > 0:  # just append
+        peaks = np.concatenate([[0], peaks])
+
+    # detect morphology: positive peaks followed by a negative one
+    peaks_values = dwt_local[peaks]
+    peaks = peaks[:-1][(peaks_values[:-1] > 0) & (peaks_values[1:] < 0)]
+
+    # zero-crossing (last positive sample) following each of these peaks
+    nonpositive = np.flatnonzero(dwt_local <= 0)
+    candidate_peaks = nonpositive[np.searchsorted(nonpositive, peaks)] - 1
+    return candidate_peaks
 
 
 def _dwt_delinate_tp_onsets_offsets(ecg, peaks, dwtmatr, sampling_rate=250, debug=False,
@@ -228,89 +251,100 @@ def _dwt_delinate_tp_onsets_offsets(ecg, peaks, dwtmatr, sampling_rate=250, debu
                                     degree_onset=2,
                                     degree_offset=2):
     degree = _dwt_compensate_degree(sampling_rate)
-    onsets = []
-    offsets = []
-    for i in range(len(peaks)):
-        # look for onsets
-        srch_idx_start = peaks[i] - int(duration * sampling_rate)
-        srch_idx_end = peaks[i]
-        if srch_idx_start is np.nan or srch_idx_end is np.nan:
-            onsets.append(np.nan)
-            continue
-        dwt_local = dwtmatr[degree_onset + degree, srch_idx_start: srch_idx_end]
-        onset_slope_peaks, onset_slope_data = scipy.signal.find_peaks(dwt_local)
-        try:
-            epsilon_onset = onset_weight * dwt_local[onset_slope_peaks[-1]]
-            candidate_onsets = np.where(dwt_local[:onset_slope_peaks[-1]] < epsilon_onset)[0]
-            onsets.append(candidate_onsets[-1] + srch_idx_start)
-        except IndexError:
-            onsets.append(np.nan)
+    peaks = np.asarray(peaks, dtype=float)
+    found = ~np.isnan(peaks)
+    peaks = np.where(found, peaks, 0).astype(int)
+
+    # look for onsets (all the beats at once, missing peaks giving empty windows)
+    srch_idx_start = np.where(found, peaks - int(duration * sampling_rate), 0)
+    srch_idx_end = np.where(found, peaks, 0)
+    dwt_local = _dwt_windows(dwtmatr[degree_onset + degree], srch_idx_start, srch_idx_end)
+    onsets = _dwt_delinate_onsets(dwt_local, onset_weight) + srch_idx_start
+
+    # look for offsets
+    srch_idx_start = np.where(found, peaks, 0)
+    srch_idx_end = np.where(found, peaks + int(duration_offset * sampling_rate), 0)
+    dwt_local = _dwt_windows(dwtmatr[degree_offset + degree], srch_idx_start, srch_idx_end)
+    offsets = _dwt_delinate_offsets(-dwt_local, offset_weight) + srch_idx_start
 
-        # # only for debugging
-        # events_plot([candidate_onsets, onset_slope_peaks], dwt_local)
-        # plt.plot(ecg[srch_idx_start: srch_idx_end], '--', label='ecg')
-        # plt.show()
+    return onsets, offsets
 
-        # look for offset
-        srch_idx_start = peaks[i]
-        srch_idx_end = peaks[i] + int(duration_offset * sampling_rate)
-        if srch_idx_start is np.nan or srch_idx_end is np.nan:
-            onsets.append(np.nan)
-            continue
-        dwt_local = dwtmatr[degree_offset + degree, srch_idx_start: srch_idx_end]
-        offset_slope_peaks, offset_slope_data = scipy.signal.find_peaks(-dwt_local)
-        try:
-            epsilon_offset = - offset_weight * dwt_local[offset_slope_peaks[0]]
-            candidate_offsets = np.where(-dwt_local[offset_slope_peaks[0]:] < epsilon_offset)[0] + offset_slope_peaks[0]
-            offsets.append(candidate_offsets[0] + srch_idx_start)
-        except IndexError:
-            offsets.append(np.nan)
 
-        # # only for debugging
-        # events_plot([candidate_offsets, offset_slope_peaks], dwt_local)
-        # plt.plot(ecg[srch_idx_start: srch_idx_end], '--', label='ecg')
-        # plt.show()
+def _dwt_delinate_qrs_bounds(ecg, rpeaks, dwtmatr, ppeaks, tpeaks, sampling_rate=250, debug=False):
+    degree = _dwt_compensate_degree(sampling_rate)
+    rpeaks = np.asarray(rpeaks[:-1], dtype=int)
+    ppeaks = np.asarray(ppeaks, dtype=float)
+    tpeaks = np.asarray(tpeaks, dtype=float)
+
+    # look for onsets (all the beats at once, missing peaks giving empty windows)
+    srch_idx_start = np.where(np.isnan(ppeaks), rpeaks, ppeaks).astype(int)
+    srch_idx_end = rpeaks
+    dwt_local = _dwt_windows(dwtmatr[2 + degree], srch_idx_start, srch_idx_end)
+    onsets = _dwt_delinate_onsets(-dwt_local, 0.5) + srch_idx_start
+
+    # look for offsets
+    srch_idx_start = rpeaks
+    srch_idx_end = np.where(np.isnan(tpeaks), rpeaks, tpeaks).astype(int)
+    dwt_local = _dwt_windows(dwtmatr[2 + degree], srch_idx_start, srch_idx_end)
+    offsets = _dwt_delinate_offsets(dwt_local, 0.5) + srch_idx_start
 
-    return np.array(onsets), np.array(offsets)
+    return onsets, offsets
 
 
-def _dwt_delinate_qrs_bounds(ecg, rpeaks, dwtmatr, ppeaks, tpeaks, sampling_rate=250, debug=False):
-    degree = int(np.log2(sampling_rate / 250))
-    onsets = []
-    offsets = []
-    for i in range(len(rpeaks) - 1):
-        # look for onsets
-        srch_idx_start = ppeaks[i]
-        srch_idx_end = rpeaks[i]
-        if srch_idx_start is np.nan or srch_idx_end is np.nan:
-            onsets.append(np.nan)
-            continue
-        dwt_local = dwtmatr[2 + degree, srch_idx_start: srch_idx_end]
-        onset_slope_peaks, onset_slope_data = scipy.signal.find_peaks(-dwt_local)
-        epsilon_onset = 0.5 * -dwt_local[onset_slope_peaks[-1]]
-        candidate_onsets = np.where(- dwt_local[:onset_slope_peaks[-1]] < epsilon_onset)[0]
-        onsets.append(candidate_onsets[-1] + srch_idx_start)
-
-        # # only for debugging
-        # events_plot(candidate_onsets, -dwt_local)
-        # plt.plot(ecg[srch_idx_start: srch_idx_end], '--', label='ecg')
-        # plt.legend()
-        # plt.show()
-
-        # look for offsets
-        srch_idx_start = rpeaks[i]
-        srch_idx_end = tpeaks[i]
-        if srch_idx_start is np.nan or srch_idx_end is np.nan:
-            offsets.append(np.nan)
-            continue
-        dwt_local = dwtmatr[2 + degree, srch_idx_start: srch_idx_end]
-        onset_slope_peaks, onset_slope_data = scipy.signal.find_peaks(dwt_local)
-        epsilon_offset = 0.5 * dwt_local[onset_slope_peaks[0]]
-        candidate_offsets = np.where(dwt_local[onset_slope_peaks[0]:] < epsilon_offset)[0] + onset_slope_peaks[0]
+def _dwt_windows(signal, starts, ends):
+    """Return the windows [start, end) of a signal as the rows of a NaN-padded array."""
+    width = max(np.max(ends - starts, initial=0), 1)
+    indices = starts[:, np.newaxis] + np.arange(width)
+    inside = (indices < ends[:, np.newaxis]) & (indices >= 0) & (indices < len(signal))
+    windows = np.full(indices.shape, np.nan)
+    windows[inside] = signal[indices[inside]]
+    return windows
+
+
+def _dwt_local_maxima(signal):
+    """Return a mask of the local maxima along the last axis (see `scipy.signal.find_peaks`)."""
+    slope = np.diff(signal, axis=-1)
+    maxima = np.zeros(np.shape(signal), dtype=bool)
+    maxima[..., 1:-1] = (slope[..., :-1] > 0) & (slope[..., 1:] < 0)
+    return maxima
+
+
+def _dwt_first_index(mask):
+    """Return the index of the first True of each row of a mask (NaN if none)."""
+    return np.where(mask.any(axis=1), np.argmax(mask, axis=1), np.nan)
+
 
-        offsets.append(candidate_offsets[0] + srch_idx_start)
+def _dwt_last_index(mask):
+    """Return the index of the last True of each row of a mask (NaN if none)."""
+    return np.where(mask.any(axis=1), mask.shape[1] - 1 - np.argmax(mask[:, ::-1], axis=1), np.nan)
 
-    return np.array(onsets), np.array(offsets)
+
+def _dwt_delinate_onsets(windows, weight):
+    """For each window, find the last sample before its last local maximum that is below a
+    fraction (weight) of this maximum."""
+    rows = np.arange(len(windows))
+    columns = np.arange(windows.shape[1])
+    slope_peaks = _dwt_last_index(_dwt_local_maxima(windows))
+    slope_peaks = np.where(np.isnan(slope_peaks), -1, slope_peaks).astype(int)
+
+    epsilon = weight * windows[rows, slope_peaks]
+    with np.errstate(invalid="ignore"):
+        candidates = (windows < epsilon[:, np.newaxis]) & (columns < slope_peaks[:, np.newaxis])
+    return _dwt_last_index(candidates)
+
+
+def _dwt_delinate_offsets(windows, weight):
+    """For each window, find the first sample after its first local maximum that is below a
+    fraction (weight) of this maximum."""
+    rows = np.arange(len(windows))
+    columns = np.arange(windows.shape[1])
+    slope_peaks = _dwt_first_index(_dwt_local_maxima(windows))
+    slope_peaks = np.where(np.isnan(slope_peaks), windows.shape[1], slope_peaks).astype(int)
+
+    epsilon = weight * windows[rows, np.minimum(slope_peaks, windows.shape[1] - 1)]
+    with np.errstate(invalid="ignore"):
+        candidates = (windows < epsilon[:, np.newaxis]) & (columns >= slope_peaks[:, np.newaxis])
+    return _dwt_first_index(candidates)
 
 
 
@@ -324,33 +358,39 @@ def _dwt_compute_multiscales(ecg: np.ndarray, max_degree):
     Returns:
         out (FIXME): FIXME
     """
-    def _apply_H_filter(signal_i, power=0):
-        zeros = np.zeros(2 ** power - 1)
-        timedelay = 2 ** power
-        banks = np.r_[
-            1.0 / 8, zeros, 3.0 / 8, zeros, 3.0 / 8, zeros, 1.0 / 8,
-        ]
-        signal_f = scipy.signal.convolve(signal_i, banks, mode='full')
-        signal_f[:-timedelay] = signal_f[timedelay:]  # timeshift: 2 steps
-        return signal_f
-
-    def _apply_G_filter(signal_i, power=0):
-        zeros = np.zeros(2 ** power - 1)
-        timedelay = 2 ** power
-        banks = np.r_[2, zeros, -2]
-        signal_f = scipy.signal.convolve(signal_i, banks, mode='full')
-        signal_f[:-timedelay] = signal_f[timedelay:]  # timeshift: 1 step
-        return signal_f
-
-    dwtmatr = []
-    intermediate_ret = np.array(ecg)
+    # The filters are applied in the frequency domain: the cascade of H filters
+    # becomes a running product of their spectra, so that each degree only
+    # costs one inverse FFT instead of two spatial convolutions with
+    # increasingly dilated (and long) filter banks.
+    nfft = scipy.fft.next_fast_len(len(ecg) + 4 * 2 ** max_degree)
+    ecg_f = scipy.fft.rfft(ecg, nfft)
+
+    # The dilated banks only have a few non-zero taps, so that their spectra
+    # are computed in closed form from z ** timedelay (obtained by repeated
+    # squaring): H = (1 + z ** timedelay) ** 3 / 8 and G = 2 - 2 * z ** timedelay
+    phasor = np.exp(-2j * np.pi * np.arange(len(ecg_f)) / nfft)
+
+    # Single precision is enough to locate the waves, and halves the memory
+    dwtmatr = np.empty((max_degree, len(ecg)), dtype=np.float32)
+    spectrum = np.empty_like(ecg_f)
+    h_bank = np.empty_like(phasor)
+    g_bank = np.empty_like(phasor)
     for deg in range(max_degree):
-        S_deg = _apply_G_filter(intermediate_ret, power=deg)
-        T_deg = _apply_H_filter(intermediate_ret, power=deg)
-        dwtmatr.append(S_deg)
-        intermediate_ret = np.array(T_deg)
-    dwtmatr = [arr[:len(ecg)] for arr in dwtmatr]  # rescale transforms to the same length
-    return np.array(dwtmatr)
+        timedelay = 2 ** deg
+        np.add(phasor, 1, out=h_bank)
+        h_bank /= 2
+        np.multiply(phasor, -2, out=g_bank)
+        g_bank += 2
+
+        # timeshift: cumulated delays of the H filters (2 ** deg - 1) plus
+        # the delay of the G filter at this degree (2 ** deg)
+        delay = 2 * timedelay - 1
+        np.multiply(ecg_f, g_bank, out=spectrum)
+        dwtmatr[deg] = scipy.fft.irfft(spectrum, nfft)[delay: delay + len(ecg)]
+        for _ in range(3):
+            ecg_f *= h_bank
+        np.multiply(phasor, phasor, out=phasor)
+    return dwtmatr
 
 
 
@@ -359,24 +399,31 @@ def _dwt_compute_multiscales(ecg: np.ndarray, max_degree):
 # =============================================================================
 def _ecg_delinator_cwt(ecg, rpeaks=None, sampling_rate=1000):
 
+    # The same transform is used by all the steps
+    cwtmatr = _ecg_delinator_cwt_transform(ecg, sampling_rate=sampling_rate)
+
     # P-Peaks and T-Peaks
     tpeaks, ppeaks = _peaks_delineator(ecg, rpeaks,
-                                       sampling_rate=sampling_rate)
+                                       sampling_rate=sampling_rate,
+                                       cwtmatr=cwtmatr)
 
     # qrs onsets and offsets
     qrs_onsets, qrs_offsets = _onset_offset_delineator(ecg, rpeaks,
                                                        peak_type="rpeaks",
-                                                       sampling_rate=sampling_rate)
+                                                       sampling_rate=sampling_rate,
+                                                       cwtmatr=cwtmatr)
 
     # ppeaks onsets and offsets
     p_onsets, p_offsets = _onset_offset_delineator(ecg, ppeaks,
                                                    peak_type="ppeaks",
-                                                   sampling_rate=sampling_rate)
+                                                   sampling_rate=sampling_rate,
+                                                   cwtmatr=cwtmatr)
 
     # tpeaks onsets and offsets
     t_onsets, t_offsets = _onset_offset_delineator(ecg, tpeaks,
                                                    peak_type="tpeaks",
-                                                   sampling_rate=sampling_rate)
+                                                   sampling_rate=sampling_rate,
+                                                   cwtmatr=cwtmatr)
 
     info = {"ECG_P_Peaks": ppeaks,
             "ECG_T_Peaks": tpeaks,
@@ -391,17 +438,23 @@ def _ecg_delinator_cwt(ecg, rpeaks=None, sampling_rate=1000):
 # Internals
 # ---------------------
 
-def _onset_offset_delineator(ecg, peaks, peak_type="rpeaks", sampling_rate=1000):
-    # Try loading pywt
-    try:
-        import pywt
-    except ImportError:
+def _ecg_delinator_cwt_transform(ecg, sampling_rate=1000):
+    if pywt is None:
         raise ImportError("NeuroKit error: ecg_delineator(): the 'PyWavelets' "
                           "module is required for this method to run. ",
                           "Please install it first (`pip install PyWavelets`).")
     # first derivative of the Gaissian signal
-    scales = np.array([1, 2, 4, 8, 16])
-    cwtmatr, freqs = pywt.cwt(ecg, scales, 'gaus1', sampling_period=1.0/sampling_rate)
+    scales = np.array([4, 16])
+    try:
+        cwtmatr, freqs = pywt.cwt(ecg, scales, 'gaus1', sampling_period=1.0/sampling_rate, method='fft')
+    except TypeError:  # PyWavelets < 1.1 has no 'method' argument (convolution only)
+        cwtmatr, freqs = pywt.cwt(ecg, scales, 'gaus1', sampling_period=1.0/sampling_rate)
+    return cwtmatr
+
+
+def _onset_offset_delineator(ecg, peaks, peak_type="rpeaks", sampling_rate=1000, cwtmatr=None):
+    if cwtmatr is None:
+        cwtmatr = _ecg_delinator_cwt_transform(ecg, sampling_rate=sampling_rate)
 
     half_wave_width = int(0.1*sampling_rate)  # NEED TO CHECK
     onsets = []
@@ -409,14 +462,14 @@ def _onset_offset_delineator(ecg, peaks, peak_type="rpeaks", sampling_rate=1000)
     for index_peak in peaks:
         # find onset
         if peak_type == "rpeaks":
-            search_window = cwtmatr[2, index_peak - half_wave_width: index_peak]
+            search_window = cwtmatr[0, index_peak - half_wave_width: index_peak]
             prominence = 0.20*max(search_window)
             height = 0.0
             wt_peaks, wt_peaks_data = find_peaks(search_window, height=height,
                                                  prominence=prominence)
 
         elif peak_type == "tpeaks" or peak_type == "ppeaks":
-            search_window = - cwtmatr[4, index_peak - half_wave_width: index_peak]
+            search_window = - cwtmatr[1, index_peak - half_wave_width: index_peak]
 
             prominence = 0.10*max(search_window)
             height = 0.0
@@ -439,10 +492,10 @@ def _onset_offset_delineator(ecg, peaks, peak_type="rpeaks", sampling_rate=1000)
             epsilon_onset = 0.25 * wt_peaks_data['peak_heights'][-1]
         leftbase = wt_peaks_data['left_bases'][-1] + index_peak - half_wave_width
         if peak_type == "rpeaks":
-            candidate_onsets = np.where(cwtmatr[2, nfirst-100: nfirst] <
+            candidate_onsets = np.where(cwtmatr[0, nfirst-100: nfirst] <
                                         epsilon_onset)[0] + nfirst - 100
         elif peak_type == "tpeaks" or peak_type == "ppeaks":
-            candidate_onsets = np.where(-cwtmatr[4, nfirst-100: nfirst] <
+            candidate_onsets = np.where(-cwtmatr[1, nfirst-100: nfirst] <
                                         epsilon_onset)[0] + nfirst - 100
 
         candidate_onsets = candidate_onsets.tolist() + [leftbase]
@@ -453,13 +506,13 @@ def _onset_offset_delineator(ecg, peaks, peak_type="rpeaks", sampling_rate=1000)
 
         # find offset
         if peak_type == "rpeaks":
-            search_window = - cwtmatr[2, index_peak: index_peak + half_wave_width]
+            search_window = - cwtmatr[0, index_peak: index_peak + half_wave_width]
             prominence = 0.50*max(search_window)
             wt_peaks, wt_peaks_data = scipy.signal.find_peaks(search_window, height=height,
                                                               prominence=prominence)
 
         elif peak_type == "tpeaks" or peak_type == "ppeaks":
-            search_window = cwtmatr[4, index_peak: index_peak + half_wave_width]
+            search_window = cwtmatr[1, index_peak: index_peak + half_wave_width]
             prominence = 0.10*max(search_window)
             wt_peaks, wt_peaks_data = find_peaks(search_window, height=height,
                                                  prominence=prominence)
@@ -479,10 +532,10 @@ def _onset_offset_delineator(ecg, peaks, peak_type="rpeaks", sampling_rate=1000)
             epsilon_offset = 0.4 * wt_peaks_data['peak_heights'][0]
         rightbase = wt_peaks_data['right_bases'][0] + index_peak
         if peak_type == "rpeaks":
-            candidate_offsets = np.where((-cwtmatr[2, nlast: nlast + 100]) <
+            candidate_offsets = np.where((-cwtmatr[0, nlast: nlast + 100]) <
                                          epsilon_offset)[0] + nlast
         elif peak_type == "tpeaks" or peak_type == "ppeaks":
-            candidate_offsets = np.where((cwtmatr[4, nlast: nlast + 100]) <
+            candidate_offsets = np.where((cwtmatr[1, nlast: nlast + 100]) <
                                          epsilon_offset)[0] + nlast
 
         candidate_offsets = candidate_offsets.tolist() + [rightbase]
@@ -498,17 +551,9 @@ def _onset_offset_delineator(ecg, peaks, peak_type="rpeaks", sampling_rate=1000)
 
 
 
-def _peaks_delineator(ecg, rpeaks, cleaning=False, sampling_rate=1000):
-    # Try loading pywt
-    try:
-        import pywt
-    except ImportError:
-        raise ImportError("NeuroKit error: ecg_delineator(): the 'PyWavelets' "
-                          "module is required for this method to run. ",
-                          "Please install it first (`pip install PyWavelets`).")
-    # first derivative of the Gaissian signal
-    scales = np.array([1, 2, 4, 8, 16])
-    cwtmatr, freqs = pywt.cwt(ecg, scales, 'gaus1', sampling_period=1.0/sampling_rate)
+def _peaks_delineator(ecg, rpeaks, cleaning=False, sampling_rate=1000, cwtmatr=None):
+    if cwtmatr is None:
+        cwtmatr = _ecg_delinator_cwt_transform(ecg, sampling_rate=sampling_rate)
 
     qrs_duration = 0.1
 
@@ -520,20 +565,17 @@ def _peaks_delineator(ecg, rpeaks, cleaning=False, sampling_rate=1000):
         # search for T peaks and P peaks from R peaks
         start = rpeaks[i] + search_boundary
         end = rpeaks[i + 1] - search_boundary
-        search_window = cwtmatr[4, start:end]
-        height = 0.25*np.sqrt(np.mean(np.square(search_window)))
-        peaks_tp, heights_tp = scipy.signal.find_peaks(np.abs(search_window), height=height)
-        peaks_tp = peaks_tp + rpeaks[i] + search_boundary
+        search_window = cwtmatr[1, start:end]
+        search_window_abs = np.abs(search_window)
+        height = 0.25*np.sqrt(search_window_abs @ search_window_abs / search_window_abs.size)
+        peaks_tp, heights_tp = scipy.signal.find_peaks(search_window_abs, height=height)
         # set threshold for heights of peaks to find significant peaks in wavelet
-        threshold = 0.125*max(search_window)
-        significant_index = []
-        significant_index = [j for j in range(len(peaks_tp)) if
-                             heights_tp["peak_heights"][j] > threshold]
-
-        significant_peaks_tp = []
-        for index in significant_index:
-            significant_peaks_tp.append(peaks_tp[index])
-        significant_peaks_groups.append(_find_tppeaks(ecg, significant_peaks_tp, sampling_rate=sampling_rate))
+        threshold = 0.125*search_window.max()
+        significant = heights_tp["peak_heights"] > threshold
+        significant_peaks_tp = (peaks_tp[significant] + start).tolist()
+        significant_peaks_groups.append(_find_tppeaks(ecg, significant_peaks_tp,
+                                                      sampling_rate=sampling_rate,
+                                                      cwtmatr=cwtmatr))
 
     tpeaks, ppeaks = zip(*[(g[0], g[-1]) for g in significant_peaks_groups])
 
@@ -542,27 +584,19 @@ def _peaks_delineator(ecg, rpeaks, cleaning=False, sampling_rate=1000):
     return tpeaks, ppeaks
 
 
-def _find_tppeaks(ecg, keep_tp, sampling_rate=1000):
-    # Try loading pywt
-    try:
-        import pywt
-    except ImportError:
-        raise ImportError("NeuroKit error: ecg_delineator(): the 'PyWavelets' "
-                          "module is required for this method to run. ",
-                          "Please install it first (`pip install PyWavelets`).")
-    # first derivative of the Gaissian signal
-    scales = np.array([1, 2, 4, 8, 16])
-    cwtmatr, freqs = pywt.cwt(ecg, scales, 'gaus1', sampling_period=1.0/sampling_rate)
+def _find_tppeaks(ecg, keep_tp, sampling_rate=1000, cwtmatr=None):
+    if cwtmatr is None:
+        cwtmatr = _ecg_delinator_cwt_transform(ecg, sampling_rate=sampling_rate)
     max_search_duration = 0.05
     tppeaks = []
     for index_cur, index_next in zip(keep_tp[:-1], keep_tp[1:]):
         # limit 1
-        correct_sign = cwtmatr[4, :][index_cur] < 0 and cwtmatr[4, :][index_next] > 0
+        correct_sign = cwtmatr[1, :][index_cur] < 0 and cwtmatr[1, :][index_next] > 0
     #    near = (index_next - index_cur) < max_wv_peak_dist #limit 2
     #    if near and correct_sign:
         if correct_sign:
             index_zero_cr = signal_zerocrossings(
-                cwtmatr[4, :][index_cur:index_next])[0] + index_cur
+                cwtmatr[1, :][index_cur:index_next])[0] + index_cur
             nb_idx = int(max_search_duration * sampling_rate)
             index_max = np.argmax(ecg[index_zero_cr - nb_idx: index_zero_cr + nb_idx]) + (index_zero_cr - nb_idx)
             tppeaks.append(index_max)
@@ -574,56 +608,39 @@ def _find_tppeaks(ecg, keep_tp, sampling_rate=1000):
 def _ecg_delineator_derivative(ecg, rpeaks=None, sampling_rate=1000):
 
     # Initialize
-    heartbeats = epochs_create(ecg, rpeaks, sampling_rate=sampling_rate, epochs_start=-0.35, epochs_end=0.5)
+    heartbeats, R = _ecg_delineator_derivative_heartbeats(ecg, rpeaks, sampling_rate=sampling_rate)
+    rpeaks = np.asarray(rpeaks, dtype=int)
+    n_beats, n_samples = heartbeats.shape
+    left = np.zeros(n_beats, dtype=int)
+    right = np.full(n_beats, n_samples)
 
-    Q_list = []
-    P_list = []
-    S_list = []
-    T_list = []
+    # Peaks (index in the heartbeats, -1 if not found) ------
+    # Q wave: most right-hand side peak on the (inverted) left hand side
+    Q = _ecg_delineator_derivative_findpeaks(heartbeats, left, np.full(n_beats, R), invert=True, last=True)
 
-    P_onsets = []
-    T_offsets = []
+    # P wave: most right-hand side peak left of the Q wave
+    P = _ecg_delineator_derivative_findpeaks(heartbeats, left, np.maximum(Q, 0), last=True)
 
-    for i, rpeak in enumerate(rpeaks):
-        heartbeat = heartbeats[str(i+1)]
+    # S wave: most left-hand side peak on the (inverted) right hand side
+    S = _ecg_delineator_derivative_findpeaks(heartbeats, np.full(n_beats, R), right, invert=True)
 
-        # Get index of heartbeat
-        R = heartbeat.index.get_loc(np.min(heartbeat.index.values[heartbeat.index.values > 0]))
+    # T wave: most left-hand side peak right of the S wave
+    T = _ecg_delineator_derivative_findpeaks(heartbeats, np.where(S >= 0, S, n_samples), right)
 
-        # Peaks ------
-        # Q wave
-        Q_index, Q = _ecg_delineator_derivative_Q(rpeak, heartbeat, R)
-        Q_list.append(Q_index)
+    # Onsets/Offsets (maximum curvature of the smoothed signal) ------
+    # P onset: left of the P wave
+    P_onsets = _ecg_delineator_derivative_curvature_max(heartbeats, left, np.maximum(P, 0), size=R/10)
 
-        # P wave
-        P_index, P = _ecg_delineator_derivative_P(rpeak, heartbeat, R, Q)
-        P_list.append(P_index)
+    # T offset: right of the T wave
+    T_offsets = _ecg_delineator_derivative_curvature_max(heartbeats, np.where(T >= 0, T, n_samples), right, size=R/10)
 
-        # S wave
-        S_index, S = _ecg_delineator_derivative_S(rpeak, heartbeat, R)
-        S_list.append(S_index)
-
-        # T wave
-        T_index, T = _ecg_delineator_derivative_T(rpeak, heartbeat, R, S)
-        T_list.append(T_index)
-
-        # Onsets/Offsets ------
-        P_onsets.append(_ecg_delineator_derivative_P_onset(rpeak, heartbeat, R, P))
-        T_offsets.append(_ecg_delineator_derivative_T_offset(rpeak, heartbeat, R, T))
-
-#    P_list = np.array(P_list, dtype='float')
-#    Q_list = np.array(Q_list, dtype='float')
-#    S_list = np.array(S_list, dtype='float')
-#    T_list = np.array(T_list, dtype='float')
-#    P_onsets = np.array(P_onsets, dtype='float')
-#    T_offsets = np.array(T_offsets, dtype='float')
-
-    out = {"ECG_P_Peaks": P_list,
-           "ECG_Q_Peaks": Q_list,
-           "ECG_S_Peaks": S_list,
-           "ECG_T_Peaks": T_list,
-           "ECG_P_Onsets": P_onsets,
-           "ECG_T_Offsets": T_offsets}
+    # Relative to R
+    out = {"ECG_P_Peaks": np.where(P >= 0, rpeaks + P - R, np.nan),
+           "ECG_Q_Peaks": np.where(Q >= 0, rpeaks + Q - R, np.nan),
+           "ECG_S_Peaks": np.where(S >= 0, rpeaks + S - R, np.nan),
+           "ECG_T_Peaks": np.where(T >= 0, rpeaks + T - R, np.nan),
+           "ECG_P_Onsets": np.where(P_onsets >= 0, rpeaks + P_onsets - R, np.nan),
+           "ECG_T_Offsets": np.where(T_offsets >= 0, rpeaks + T_offsets - R, np.nan)}
 
     return out
 
@@ -631,89 +648,128 @@ def _ecg_delineator_derivative(ecg, rpeaks=None, sampling_rate=1000):
 # Internal
 # --------------------------
 
-def _ecg_delineator_derivative_Q(rpeak, heartbeat, R):
-    segment = heartbeat[:0]  # Select left hand side
-
-    Q = signal_findpeaks(-1*segment["Signal"],
-                         height_min=0.05 * (segment["Signal"].max() -
-                                            segment["Signal"].min()))
-    if len(Q["Peaks"]) == 0:
-        return np.nan, None
-    Q = Q["Peaks"][-1]  # Select most right-hand side
-    from_R = R - Q  # Relative to R
-    return rpeak - from_R, Q
-
-
-
-def _ecg_delineator_derivative_P(rpeak, heartbeat, R, Q):
-    if Q is None:
-        return np.nan, None
-
-    segment = heartbeat.iloc[:Q]  # Select left of Q wave
-    P = signal_findpeaks(segment["Signal"],
-                         height_min=0.05 * (segment["Signal"].max() -
-                                            segment["Signal"].min()))
-
-    if len(P["Peaks"]) == 0:
-        return np.nan, None
-    P = P["Peaks"][-1]  # Select most right-hand side
-    from_R = R - P  # Relative to R
-    return rpeak - from_R, P
-
+def _ecg_delineator_derivative_heartbeats(ecg, rpeaks, sampling_rate=1000, epochs_start=-0.35, epochs_end=0.5):
+    """Return the heartbeats (from 0.35 s before to 0.5 s after each R-peak) as the rows of a
+    NaN-padded array, along with the index of the R-peak in each row.
 
-
-
-def _ecg_delineator_derivative_S(rpeak, heartbeat, R):
-    segment = heartbeat[0:]  # Select right hand side
-    S = signal_findpeaks(-segment["Signal"],
-                         height_min=0.05 * (segment["Signal"].max() -
-                                            segment["Signal"].min()))
-
-    if len(S["Peaks"]) == 0:
-        return np.nan, None
-
-    S = S["Peaks"][0]  # Select most left-hand side
-    return rpeak + S, S
-
-
-
-def _ecg_delineator_derivative_T(rpeak, heartbeat, R, S):
-    if S is None:
-        return np.nan, None
-
-    segment = heartbeat.iloc[R + S:]  # Select right of S wave
-    T = signal_findpeaks(segment["Signal"],
-                         height_min=0.05 * (segment["Signal"].max() -
-                                            segment["Signal"].min()))
-
-    if len(T["Peaks"]) == 0:
-        return np.nan, None
-
-    T = S + T["Peaks"][0]  # Select most left-hand side
-    return rpeak + T, T
-
-
-def _ecg_delineator_derivative_P_onset(rpeak, heartbeat, R, P):
-    if P is None:
-        return np.nan
-
-    segment = heartbeat.iloc[:P]  # Select left of P wave
-    signal = signal_smooth(segment["Signal"].values, size=R/10)
-    signal = np.gradient(np.gradient(signal))
-    P_onset = np.argmax(signal)
-
-    from_R = R - P_onset  # Relative to R
-    return rpeak - from_R
-
-
-
-def _ecg_delineator_derivative_T_offset(rpeak, heartbeat, R, T):
-    if T is None:
-        return np.nan
-
-    segment = heartbeat.iloc[R + T:]  # Select left of P wave
-    signal = signal_smooth(segment["Signal"].values, size=R/10)
-    signal = np.gradient(np.gradient(signal))
-    T_offset = np.argmax(signal)
-
-    return rpeak + T + T_offset
+    The windows are the same as the epochs of `epochs_create`.
+    """
+    ecg = np.ascontiguousarray(ecg, dtype=float)
+    rpeaks = np.asarray(rpeaks, dtype=int)
+
+    # Same (rounded) bounds as epochs_create
+    padding = int((epochs_end - epochs_start) * sampling_rate)
+    win_pre = padding - int(padding + epochs_start * sampling_rate)
+    win_post = int(padding + epochs_end * sampling_rate) - padding
+    starts = rpeaks - win_pre
+
+    # Only pad the signal with NaNs if some heartbeats are truncated
+    if len(rpeaks) > 0 and (np.min(starts) < 0 or np.max(rpeaks) + win_post > len(ecg)):
+        padded = np.full(len(ecg) + 2 * padding, np.nan)
+        padded[padding:padding + len(ecg)] = ecg
+        ecg = padded
+        starts = starts + padding
+
+    # Copy the heartbeats from a (read-only) view of all the windows of the signal
+    width = win_pre + win_post
+    windows = np.lib.stride_tricks.as_strided(ecg, shape=(max(len(ecg) - width + 1, 0), width),
+                                              strides=(ecg.strides[0], ecg.strides[0]),
+                                              writeable=False)
+    heartbeats = windows[starts]
+    return heartbeats, win_pre
+
+
+def _ecg_delineator_derivative_findpeaks(heartbeats, starts, ends, invert=False, last=False):
+    """Find the first (or last) peak of the segment [start, end) of each heartbeat, all the
+    heartbeats at once.
+
+    The peaks are those of `signal_findpeaks` with a minimum height (prominence) of 5% of the
+    amplitude of the segment. Returns their index in the heartbeats (-1 if none is found).
+    """
+    n_beats, n_samples = heartbeats.shape
+    inside = (np.arange(n_samples) >= starts[:, np.newaxis]) & (np.arange(n_samples) < ends[:, np.newaxis])
+
+    # Segments are separated by +inf, at which the bases of the prominences stop
+    values = -heartbeats[inside] if invert is True else heartbeats[inside]
+    stack = np.full((n_beats, n_samples + 1), np.inf)
+    stack[:, :-1][inside] = values
+
+    # Amplitude of all the (non-empty) segments at once, from their contiguous values
+    lengths = np.count_nonzero(inside, axis=1)
+    amplitude = np.full(n_beats, np.nan)
+    offsets = (np.cumsum(lengths) - lengths)[lengths > 0]
+    amplitude[lengths > 0] = np.fmax.reduceat(values, offsets) - np.fmin.reduceat(values, offsets)
+
+    stack = stack.ravel()
+    peaks, _ = scipy.signal.find_peaks(stack)
+    peaks = peaks[np.isfinite(stack[peaks])]  # drop the plateaus of separators
+    heights = scipy.signal.peak_prominences(stack, peaks)[0]
+    beats, peaks = np.divmod(peaks, n_samples + 1)
+    keep = ~(heights < 0.05 * amplitude[beats])
+    beats, peaks = beats[keep], peaks[keep]
+
+    if last is True:
+        beats, peaks = beats[::-1], peaks[::-1]
+    found = np.full(n_beats, -1)
+    beats, first = np.unique(beats, return_index=True)
+    found[beats] = peaks[first]
+    return found
+
+
+def _ecg_delineator_derivative_curvature_max(heartbeats, starts, ends, size=10):
+    """Find the point of maximum curvature (second derivative) of the smoothed segment
+    [start, end) of each heartbeat, all the heartbeats at once.
+
+    The segments are smoothed as with `signal_smooth` (boxcar then parzen kernels, the edges
+    being extended by the first and last values). Returns the index of the points in the
+    heartbeats (-1 for empty segments).
+    """
+    found = np.full(len(heartbeats), -1)
+    beats = np.flatnonzero(ends > starts)
+    if len(beats) == 0:
+        return found
+
+    starts = starts[beats]
+    lengths = ends[beats] - starts
+    if size < 1 or np.any(size > lengths):
+        raise TypeError("NeuroKit error: signal_smooth(): 'size' "
+                        "should be between 1 and length of the signal.")
+
+    # Segments aligned on their start, and extended by their last value
+    rows = np.arange(len(beats))[:, np.newaxis]
+    columns = np.minimum(np.arange(np.max(lengths)), lengths[:, np.newaxis] - 1)
+    segments = heartbeats[beats[:, np.newaxis], starts[:, np.newaxis] + columns]
+
+    # Boxcar (a running mean, no kernel needed) then parzen smoothing
+    size = int(size)
+    segments = scipy.ndimage.uniform_filter1d(segments, size, axis=1, mode="nearest")
+    segments = segments[rows, columns]  # Extend again by the last (smoothed) value
+    window = scipy.signal.get_window("parzen", size)
+    segments = scipy.ndimage.convolve1d(segments, window / window.sum(), axis=1,
+                                        mode="nearest", origin=size % 2 - 1)
+    segments = segments[rows, columns]
+
+    curvature = _ecg_delineator_derivative_curvature(segments, lengths)
+    curvature[columns < np.arange(columns.shape[1])] = -np.inf
+    found[beats] = starts + np.argmax(curvature, axis=1)
+    return found
+
+
+def _ecg_delineator_derivative_curvature(signals, lengths):
+    """Same as `np.gradient(np.gradient(signal))` for each row signal[:length] of a 2D array
+    (the values beyond are not used), computed for all the rows at once."""
+    rows = np.arange(len(signals))
+    last = lengths - 1
+
+    gradient = np.empty(signals.shape)
+    np.subtract(signals[:, 2:], signals[:, :-2], out=gradient[:, 1:-1])
+    gradient[:, 1:-1] /= 2.
+    gradient[:, 0] = signals[:, 1] - signals[:, 0]
+    gradient[rows, last] = signals[rows, last] - signals[rows, last - 1]
+
+    curvature = np.empty(signals.shape)
+    np.subtract(gradient[:, 2:], gradient[:, :-2], out=curvature[:, 1:-1])
+    curvature[:, 1:-1] /= 2.
+    curvature[:, 0] = gradient[:, 1] - gradient[:, 0]
+    curvature[rows, last] = gradient[rows, last] - gradient[rows, last - 1]
+    return curvature
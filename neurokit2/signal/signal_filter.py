@@ -1,18 +1,23 @@
 # -*- coding: utf-8 -*-
+import concurrent.futures
+import functools
+import os
+
 import numpy as np
+import pandas as pd
+import scipy.ndimage
 import scipy.signal
 
 
-def signal_filter(signal, sampling_rate=1000, lowcut=None, highcut=None, method="butterworth", order=2, window_length="default"):
+def signal_filter(signal, sampling_rate=1000, lowcut=None, highcut=None, method="butterworth", order=2, window_length="default", zero_phase=True, dtype=None):
     """Filter a signal using 'butterworth', 'fir' or 'savgol' filters.
 
     Apply a lowpass (if 'highcut' frequency is provided), highpass (if 'lowcut' frequency is provided) or bandpass (if both are provided) filter to the signal.
 
     Parameters
     ----------
-    signal : list, array or Series
-        The signal channel in the form of a vector of values.
-        or "bandstop".
+    signal : list, array, Series or DataFrame
+        The signal channel in the form of a vector of values. Multiple channels can be passed as the columns of a DataFrame or as the rows of a 2D array (i.e., filtered along the last axis, as with scipy). Large multi-channel signals (of more than about a million samples) are split into blocks of channels filtered in parallel threads.
     sampling_rate : int
         The sampling frequency of the signal (in Hz, i.e., samples/second).
     lowcut : float
@@ -25,6 +30,10 @@ def signal_filter(signal, sampling_rate=1000, lowcut=None, highcut=None, method=
         Only used if method is 'butterworth' or 'savgol'. Order of the filter (default is 2).
     window_length : int
         Only used if method is 'savgol'. The length of the filter window (i.e. the number of coefficients). Must be an odd integer. If 'default', will be set to the sampling rate divided by 10 (101 if the sampling rate is 1000 Hz).
+    zero_phase : bool
+        Only used if method is 'butterworth' or 'bessel'. If True (default), the filter is applied forward and backward (`scipy.signal.sosfiltfilt`), which cancels its phase shift. If False, it is only applied forward (`scipy.signal.sosfilt`), which is about twice as fast but delays the signal.
+    dtype : str or type
+        The floating point type of the filtered signal (default is None, i.e., float64). With 'float32', the 'butterworth', 'bessel' and 'savgol' filters are computed in single precision, which halves the memory used at the cost of a lower accuracy (errors relative to the signal amplitude of the order of 1e-4 for second order IIR filters, 1e-3 for higher orders, and up to several percent for very low cutoffs, e.g., a fifth order highpass at 0.05 Hz), usually sufficient for physiological signals. The other methods are computed in double precision and converted. If None, single precision signals are also filtered in double precision.
 
     See Also
     --------
@@ -33,7 +42,7 @@ def signal_filter(signal, sampling_rate=1000, lowcut=None, highcut=None, method=
     Returns
     -------
     array
-        Vector containing the filtered signal.
+        Vector containing the filtered signal (or 2D array or DataFrame of the filtered channels if multiple channels are passed).
 
     Examples
     --------
@@ -81,20 +90,50 @@ def signal_filter(signal, sampling_rate=1000, lowcut=None, highcut=None, method=
     """
     method = method.lower()
 
+    # Multiple channels as the columns of a DataFrame (filtered as the rows of an array)
+    if isinstance(signal, pd.DataFrame):
+        filtered = signal_filter(signal.values.T, sampling_rate=sampling_rate, lowcut=lowcut, highcut=highcut,
+                                 method=method, order=order, window_length=window_length,
+                                 zero_phase=zero_phase, dtype=dtype)
+        return pd.DataFrame(np.transpose(filtered), index=signal.index, columns=signal.columns)
+
+    if dtype is not None:
+        signal = np.asarray(signal, dtype=dtype)
+
     # Sanity checks
     if method != "powerline":
         if lowcut is None and highcut is None:
             return signal
 
+    # Multiple channels as the rows of an array are filtered along the last axis (as with scipy),
+    # in one call or, for large arrays, in blocks of rows filtered in parallel
+    kwargs = dict(sampling_rate=sampling_rate, lowcut=lowcut, highcut=highcut, method=method, order=order,
+                  window_length=window_length, zero_phase=zero_phase, dtype=dtype)
+    if np.ndim(signal) == 2 and np.size(signal) >= _signal_filter_parallel_size and len(signal) > 1 \
+            and (os.cpu_count() or 1) > 1:
+        filtered = _signal_filter_parallel(signal, **kwargs)
+    else:
+        filtered = _signal_filter_method(signal, **kwargs)
+
+    if dtype is not None:
+        filtered = np.asarray(filtered, dtype=dtype)
+    return filtered
+
+
+def _signal_filter_method(signal, sampling_rate=1000, lowcut=None, highcut=None, method="butterworth", order=2,
+                          window_length="default", zero_phase=True, dtype=None):
+    """Filter a signal (or the rows of a 2D array) with the given method."""
     if method in ["sg", "savgol", "savitzky-golay"]:
-        filtered = _signal_filter_savgol(signal, sampling_rate, order, window_length=window_length)
+        filtered = _signal_filter_savgol(signal, sampling_rate, order, window_length=window_length, dtype=dtype)
     else:
         if method in ["butter", "butterworth"]:
-            filtered = _signal_filter_butterworth(signal, sampling_rate, lowcut, highcut, order)
+            filtered = _signal_filter_butterworth(signal, sampling_rate, lowcut, highcut, order, zero_phase=zero_phase,
+                                                  dtype=dtype)
         elif method in ["butter_ba", "butterworth_ba"]:
             filtered = _signal_filter_butterworth_ba(signal, sampling_rate, lowcut, highcut, order)
         elif method in ["bessel"]:
-            filtered = _signal_filter_bessel(signal, sampling_rate, lowcut, highcut, order)
+            filtered = _signal_filter_bessel(signal, sampling_rate, lowcut, highcut, order, zero_phase=zero_phase,
+                                              dtype=dtype)
         elif method in ["fir"]:
             filtered = _signal_filter_fir(signal, sampling_rate, lowcut, highcut, window_length=window_length)
         elif method in ["powerline"]:
@@ -106,20 +145,68 @@ def signal_filter(signal, sampling_rate=1000, lowcut=None, highcut=None, method=
     return filtered
 
 
+# Minimum number of samples of a multi-channel signal for its channels to be filtered in parallel
+_signal_filter_parallel_size = 2 ** 20
+
+
+def _signal_filter_parallel(signal, **kwargs):
+    """Filter the rows of a 2D array in blocks (one per CPU), each block being filtered in one call
+    by a thread of a shared pool. The scipy filters (and the numpy cumulative sums of the powerline
+    method) release the GIL while they run, so that the blocks are filtered concurrently.
+    """
+    blocks = np.array_split(np.asarray(signal), min(len(signal), os.cpu_count() or 1))
+    filtered = _signal_filter_executor().map(functools.partial(_signal_filter_method, **kwargs), blocks)
+    return np.concatenate(list(filtered))
+
+
+@functools.lru_cache(maxsize=1)
+def _signal_filter_executor():
+    """Create (once) the pool of threads used to filter large multi-channel signals."""
+    return concurrent.futures.ThreadPoolExecutor(max_workers=os.cpu_count() or 1)
+
+
 # =============================================================================
 # Savitzky-Golay (savgol)
 # =============================================================================
 
-def _signal_filter_savgol(signal, sampling_rate=1000, order=2, window_length="default"):
+def _signal_filter_savgol(signal, sampling_rate=1000, order=2, window_length="default", dtype=None):
     """Filter a signal using the Savitzky-Golay method.
 
     Default window size is chosen based on `Sadeghi, M., & Behnia, F. (2018). Optimum window length of Savitzky-Golay filters with arbitrary order. arXiv preprint arXiv:1808.10489. <https://arxiv.org/ftp/arxiv/papers/1808/1808.10489.pdf>`_.
     """
     window_length = _signal_filter_windowlength(window_length=window_length, sampling_rate=sampling_rate)
-
-    filtered = scipy.signal.savgol_filter(signal, window_length=window_length, polyorder=order)
+    signal = _signal_filter_asarray(signal, dtype=dtype)
+    length = signal.shape[-1]
+    if window_length > length:
+        raise ValueError("If mode is 'interp', window_length must be less "
+                         "than or equal to the size of x.")
+
+    # Same as scipy.signal.savgol_filter(mode='interp'), along the last axis, with the
+    # coefficients cached
+    coeffs, edges = _signal_filter_savgol_coeffs(window_length, order)
+    filtered = scipy.ndimage.convolve1d(signal, coeffs.astype(signal.dtype, copy=False), axis=-1, mode="constant")
+
+    # Polynomials fitted on the first and last windows at the edges
+    halflen = window_length // 2
+    filtered[..., :halflen] = signal[..., :window_length] @ edges.T
+    filtered[..., length - halflen:] = signal[..., -window_length:] @ edges[::-1, ::-1].T
     return filtered
 
+
+@functools.lru_cache(maxsize=32)
+def _signal_filter_savgol_coeffs(window_length, order):
+    """Compute (and cache) the Savitzky-Golay coefficients, along with the matrix giving the
+    values, at the first half window, of the polynomial fitted on the first window.
+    """
+    coeffs = scipy.signal.savgol_coeffs(window_length, order)
+
+    # Centered and scaled positions for a well-conditioned fit
+    halflen = window_length // 2
+    positions = (np.arange(window_length) - halflen) / max(halflen, 1)
+    vander = np.vander(positions, order + 1)
+    edges = vander[:halflen] @ np.linalg.pinv(vander)
+    return coeffs, edges
+
 # =============================================================================
 # FIR
 # =============================================================================
@@ -157,16 +244,30 @@ def _signal_filter_fir(signal, sampling_rate=1000, lowcut=None, highcut=None, wi
 # Butterworth
 # =============================================================================
 
-def _signal_filter_butterworth(signal, sampling_rate=1000, lowcut=None, highcut=None, order=5):
+def _signal_filter_butterworth(signal, sampling_rate=1000, lowcut=None, highcut=None, order=5, zero_phase=True,
+                               dtype=None):
     """Filter a signal using IIR Butterworth SOS method.
     """
     freqs, filter_type = _signal_filter_sanitize(lowcut=lowcut, highcut=highcut, sampling_rate=sampling_rate)
 
-    sos = scipy.signal.butter(order, freqs, btype=filter_type, output='sos', fs=sampling_rate)
-    filtered = scipy.signal.sosfiltfilt(sos, signal)
+    sos, zi = _signal_filter_butterworth_sos(order, tuple(freqs), filter_type, sampling_rate)
+    if zero_phase is True:
+        filtered = _signal_filter_sosfiltfilt(signal, sos, zi, sampling_rate=sampling_rate, dtype=dtype)
+    else:
+        signal = _signal_filter_asarray(signal, dtype=dtype)
+        filtered = _signal_filter_sosfilt(signal, sos.astype(signal.dtype, copy=False))
     return filtered
 
 
+@functools.lru_cache(maxsize=128)
+def _signal_filter_butterworth_sos(order, freqs, filter_type, sampling_rate):
+    """Design (and cache) the second-order sections of a Butterworth filter, along with their
+    steady-state initial conditions.
+    """
+    sos = scipy.signal.butter(order, list(freqs), btype=filter_type, output='sos', fs=sampling_rate)
+    return sos, scipy.signal.sosfilt_zi(sos)
+
+
 def _signal_filter_butterworth_ba(signal, sampling_rate=1000, lowcut=None, highcut=None, order=5):
     """Filter a signal using IIR Butterworth B/A method.
     """
@@ -186,13 +287,79 @@ def _signal_filter_butterworth_ba(signal, sampling_rate=1000, lowcut=None, highc
 # Bessel
 # =============================================================================
 
-def _signal_filter_bessel(signal, sampling_rate=1000, lowcut=None, highcut=None, order=5):
+def _signal_filter_bessel(signal, sampling_rate=1000, lowcut=None, highcut=None, order=5, zero_phase=True,
+                          dtype=None):
     freqs, filter_type = _signal_filter_sanitize(lowcut=lowcut, highcut=highcut, sampling_rate=sampling_rate)
 
-    sos = scipy.signal.bessel(order, freqs, btype=filter_type, output='sos', fs=sampling_rate)
-    filtered = scipy.signal.sosfiltfilt(sos, signal)
+    sos, zi = _signal_filter_bessel_sos(order, tuple(freqs), filter_type, sampling_rate)
+    if zero_phase is True:
+        filtered = _signal_filter_sosfiltfilt(signal, sos, zi, sampling_rate=sampling_rate, dtype=dtype)
+    else:
+        signal = _signal_filter_asarray(signal, dtype=dtype)
+        filtered = _signal_filter_sosfilt(signal, sos.astype(signal.dtype, copy=False))
     return filtered
 
+
+@functools.lru_cache(maxsize=128)
+def _signal_filter_bessel_sos(order, freqs, filter_type, sampling_rate):
+    """Design (and cache) the second-order sections of a Bessel filter, along with their
+    steady-state initial conditions.
+    """
+    sos = scipy.signal.bessel(order, list(freqs), btype=filter_type, output='sos', fs=sampling_rate)
+    return sos, scipy.signal.sosfilt_zi(sos)
+
+
+def _signal_filter_sosfiltfilt(signal, sos, zi, sampling_rate=1000, dtype=None):
+    """Forward-backward filtering with second-order sections.
+
+    Same as `scipy.signal.sosfiltfilt` (with its default odd padding), but using the initial
+    conditions cached along with the filter design instead of solving for them on every call.
+    For short signals (up to 10 seconds), the padding is limited to a quarter of the signal,
+    so that short segments (e.g., heartbeats) can be filtered. As with scipy, the signal is
+    filtered along its last axis.
+    """
+    signal = _signal_filter_asarray(signal, dtype=dtype)
+    sos = sos.astype(signal.dtype, copy=False)
+    length = signal.shape[-1]
+
+    # Initial conditions (per section), broadcast against the channels of the signal
+    zi = zi.astype(signal.dtype, copy=False).reshape((len(sos),) + (1,) * (signal.ndim - 1) + (2,))
+
+    # Same padding length as scipy
+    ntaps = 2 * len(sos) + 1 - min(np.sum(sos[:, 2] == 0), np.sum(sos[:, 5] == 0))
+    edge = 3 * ntaps
+    if length <= 10 * sampling_rate:
+        edge = min(edge, length // 4)
+    if length <= edge:
+        raise ValueError("The length of the input vector x must be greater "
+                         "than padlen, which is %d." % edge)
+
+    # Odd extension of the signal at both ends
+    extended = np.concatenate((2 * signal[..., :1] - signal[..., edge:0:-1],
+                               signal,
+                               2 * signal[..., -1:] - signal[..., -2:-(edge + 2):-1]), axis=-1)
+
+    filtered = _signal_filter_sosfilt(extended, sos, zi=zi * extended[..., :1])
+    filtered = _signal_filter_sosfilt(filtered[..., ::-1], sos, zi=zi * filtered[..., -1:])
+    return filtered[..., ::-1][..., edge:length + edge]
+
+
+def _signal_filter_sosfilt(signal, sos, zi=None):
+    """Same as `scipy.signal.sosfilt` (returning only the filtered signal), along the last axis.
+
+    Filters made of a single section (e.g., the default second order lowpass or highpass
+    filters) are applied with `scipy.signal.lfilter`, which has much less overhead (about 5
+    times faster on signals of a few thousand samples).
+    """
+    if len(sos) == 1:
+        if zi is None:
+            return scipy.signal.lfilter(sos[0, :3], sos[0, 3:], signal)
+        return scipy.signal.lfilter(sos[0, :3], sos[0, 3:], signal, zi=zi[0])[0]
+
+    if zi is None:
+        return scipy.signal.sosfilt(sos, signal)
+    return scipy.signal.sosfilt(sos, signal, zi=zi)[0]
+
 # =============================================================================
 # Poweline
 # =============================================================================
@@ -200,24 +367,52 @@ def _signal_filter_bessel(signal, sampling_rate=1000, lowcut=None, highcut=None,
 def _signal_filter_powerline(signal, sampling_rate):
     """This is a way of smoothing out 50Hz power-line noise from the signal as
     implemented in BioSPPy. Effectively a notch filter."""
-    b = np.ones(int(0.02 * sampling_rate)) / 50.
-    a = [1]
-    y = scipy.signal.filtfilt(b, a, signal, method="pad")
-    return y
+    # Same as scipy.signal.filtfilt(np.ones(window) / 50., [1], signal), with the moving
+    # sums computed from cumulative sums
+    window = int(0.02 * sampling_rate)
+    signal = np.asarray(signal, dtype=float)
+
+    # Odd extension of the signal at both ends (same padding length as scipy), along the last
+    # axis as with scipy
+    edge = 3 * window
+    if signal.shape[-1] <= edge:
+        raise ValueError("The length of the input vector x must be greater "
+                         "than padlen, which is %d." % edge)
+    extended = np.concatenate((2 * signal[..., :1] - signal[..., edge:0:-1],
+                               signal,
+                               2 * signal[..., -1:] - signal[..., -2:-(edge + 2):-1]), axis=-1)
+
+    # Forward and backward passes, each starting from the steady state of its first value
+    y = _signal_filter_movingsum(extended, window) / 50.
+    y = _signal_filter_movingsum(y[..., ::-1], window)[..., ::-1] / 50.
+    return y[..., edge:-edge]
+
+
+def _signal_filter_movingsum(signal, window):
+    """Causal moving sum along the last axis, as if the signal was preceded by its first value."""
+    first = np.repeat(signal[..., :1], window, axis=-1)
+    cumsum = np.cumsum(np.concatenate((first, signal), axis=-1), axis=-1)
+    return cumsum[..., window:] - cumsum[..., :-window]
 
 
 # =============================================================================
 # Utility
 # =============================================================================
+# Filter type given (lowcut is not None, highcut is not None, lowcut > highcut)
+_signal_filter_types = {(True, True, False): "bandpass",
+                        (True, True, True): "bandstop",
+                        (True, False, False): "highpass",
+                        (False, True, False): "lowpass"}
+
+
 def _signal_filter_sanitize(lowcut=None, highcut=None, sampling_rate=1000, normalize=False):
 
     # Sanity checks
-    if isinstance(highcut, int):
-        if sampling_rate <= 2 * highcut:
-            print("NeuroKit warning: the sampling rate is too low. Sampling rate"
-                  " must exceed the Nyquist rate to avoid aliasing problem. "
-                  "In this analysis, the sampling rate has to be higher than",
-                  2 * highcut, "Hz.")
+    if highcut is not None and sampling_rate <= 2 * highcut:
+        print("NeuroKit warning: the sampling rate is too low. Sampling rate"
+              " must exceed the Nyquist rate to avoid aliasing problem. "
+              "In this analysis, the sampling rate has to be higher than",
+              2 * highcut, "Hz.")
 
     # Replace 0 by none
     if lowcut is not None and lowcut == 0:
@@ -226,18 +421,13 @@ def _signal_filter_sanitize(lowcut=None, highcut=None, sampling_rate=1000, norma
         highcut = None
 
     # Format
-    if lowcut is not None and highcut is not None:
-        if lowcut > highcut:
-            filter_type = "bandstop"
-        else:
-            filter_type = "bandpass"
-        freqs = [lowcut, highcut]
-    elif lowcut is not None:
-        freqs = [lowcut]
-        filter_type = "highpass"
-    elif highcut is not None:
-        freqs = [highcut]
-        filter_type = "lowpass"
+    freqs = [freq for freq in [lowcut, highcut] if freq is not None]
+    if len(freqs) == 0:
+        raise ValueError("NeuroKit error: signal_filter(): 'lowcut' and 'highcut' "
+                         "cannot both be 0 (at least one cutoff frequency is required).")
+    filter_type = _signal_filter_types[(lowcut is not None,
+                                        highcut is not None,
+                                        len(freqs) == 2 and lowcut > highcut)]
 
     # Normalize frequency to Nyquist Frequency (Fs/2).
     # However, no need to normalize if `fs` argument is provided to the scipy filter
@@ -247,6 +437,12 @@ def _signal_filter_sanitize(lowcut=None, highcut=None, sampling_rate=1000, norma
     return freqs, filter_type
 
 
+def _signal_filter_asarray(signal, dtype=None):
+    """Convert the signal to a floating point array of the requested dtype (double precision by
+    default, even for single precision signals)."""
+    return np.asarray(signal, dtype=float if dtype is None else dtype)
+
+
 def _signal_filter_windowlength(window_length="default", sampling_rate=1000):
     if isinstance(window_length, str):
         window_length = int(np.round(sampling_rate/3))
@@ -5,6 +5,9 @@ import numpy as np
 import pandas as pd
 import matplotlib.pyplot as plt
 
+from neurokit2.ecg.ecg_delineate import (_dwt_delinate_qrs_bounds, _dwt_delinate_tp_candidates,
+                                         _dwt_delinate_tp_onsets_offsets)
+
 
 SHOW_DEBUG_PLOTS = False
 MAX_SIGNAL_DIFF = 0.03  # seconds
@@ -68,6 +71,30 @@ def run_test_func(test_data):
 ])
 def test_find_ecg_characteristics(attribute, test_data):
     ecg_characteristics = run_test_func(test_data)
+    helper_check(attribute, ecg_characteristics, test_data)
+
+
+@pytest.mark.parametrize('attribute', [
+    'ECG_T_Peaks',
+    'ECG_T_Onsets',
+    'ECG_T_Offsets',
+    'ECG_P_Peaks', 'ECG_P_Onsets', 'ECG_P_Offsets',
+    'ECG_R_Onsets', 'ECG_R_Offsets'
+])
+@pytest.mark.parametrize('sampling_rate', [250, 500])
+def test_find_ecg_characteristics_native_rate(attribute, sampling_rate, test_data):
+    # At 250 and 500 Hz, the signal is delineated without being resampled to 2000 Hz
+    factor = test_data['sampling_rate'] // sampling_rate
+    ecg = nk.signal_resample(test_data['ecg'], sampling_rate=test_data['sampling_rate'],
+                             desired_sampling_rate=sampling_rate)
+    test_data = dict(ecg=ecg, sampling_rate=sampling_rate,
+                     rpeaks=np.asarray(test_data['rpeaks']) // factor,
+                     **{attribute: test_data[attribute] // factor})
+    ecg_characteristics = run_test_func(test_data)
+    helper_check(attribute, ecg_characteristics, test_data)
+
+
+def helper_check(attribute, ecg_characteristics, test_data):
     corresponding_points = []  #: List of missing peaks attribute
     for peak_index in test_data[attribute]:
         min_idx = np.argmin(np.abs(ecg_characteristics[attribute] - peak_index))
@@ -84,3 +111,44 @@ Difference:
     # helper_plot(attribute, ecg_characteristics, test_data)
     assert diff.std() < 0.1 * test_data['sampling_rate'], report
     assert diff.mean() < 0.1 * test_data['sampling_rate'], report
+
+
+def helper_dwtmatr(sampling_rate=250, length=1000):
+    """Multiscales with one sinusoidal slope peak every 50 samples (no plateaus)."""
+    wave = np.sin(2 * np.pi * 5 * np.arange(length) / sampling_rate + 0.05)
+    return np.tile(wave, (5, 1))
+
+
+def test_dwt_onsets_offsets_missing_peaks():
+    dwtmatr = helper_dwtmatr()
+    onsets, offsets = _dwt_delinate_tp_onsets_offsets(None, [np.nan, 500], dwtmatr, sampling_rate=250)
+    assert np.isnan(onsets[0]) and np.isnan(offsets[0])
+    assert onsets[1] == 452 and offsets[1] == 547
+
+    # The QRS offset of a beat is found even if its P peak is missing (and vice versa)
+    onsets, offsets = _dwt_delinate_qrs_bounds(None, [300, 600, 900], dwtmatr, [np.nan, 550], [350, np.nan],
+                                               sampling_rate=250)
+    assert np.isnan(onsets[0]) and offsets[0] == 321
+    assert onsets[1] == 578 and np.isnan(offsets[1])
+
+    # No slope peak in the search window
+    ramp = np.tile(np.arange(1000, dtype=float), (5, 1))
+    onsets, offsets = _dwt_delinate_tp_onsets_offsets(None, [500], ramp, sampling_rate=250)
+    assert np.isnan(onsets[0]) and np.isnan(offsets[0])
+
+
+def test_dwt_onsets_offsets_signal_edges():
+    # The search windows of the first and last peaks are clipped to the signal
+    dwtmatr = helper_dwtmatr()
+    onsets, offsets = _dwt_delinate_tp_onsets_offsets(None, [40, 960], dwtmatr, sampling_rate=250)
+    assert onsets[0] == 2 and offsets[0] == 97
+    assert onsets[1] == 902 and offsets[1] == 997
+
+
+def test_dwt_tp_candidates_close_peaks():
+    # A positive peak closely followed by a smaller negative one (4 samples, i.e., 16 ms at
+    # 250 Hz) still forms a candidate pair, with its zero-crossing
+    dwt_local = np.zeros(40)
+    dwt_local[8:13] = [0.2, 0.6, 1, 0.6, 0.2]
+    dwt_local[13:16] = [-0.2, -0.5, -0.2]
+    assert list(_dwt_delinate_tp_candidates(dwt_local, height=0.1)) == [12]
@@ -1,5 +1,6 @@
 import numpy as np
 import pandas as pd
+import pytest
 import neurokit2 as nk
 import scipy.signal
 
@@ -102,6 +103,29 @@ def test_signal_filter():
     signal += np.cos(np.linspace(start=0, stop=100, num=1000)) # High freq
     filtered = nk.signal_filter(signal, highcut=10)
     assert np.std(signal) > np.std(filtered)
+    filtered = nk.signal_filter(signal, highcut=10, zero_phase=False)
+    assert np.std(signal) > np.std(filtered)
+    filtered = nk.signal_filter(signal, highcut=10, dtype="float32")
+    assert filtered.dtype == np.float32
+    assert np.allclose(filtered, nk.signal_filter(signal, highcut=10), atol=1e-3)
+    # Single precision signals are filtered in double precision unless requested otherwise
+    filtered = nk.signal_filter(signal.astype(np.float32), lowcut=1, highcut=10, order=5)
+    assert filtered.dtype == np.float64
+    assert np.array_equal(filtered, nk.signal_filter(signal.astype(np.float32).astype(float), lowcut=1, highcut=10, order=5))
+
+    # Multiple channels
+    signals = pd.DataFrame({"A": signal, "B": signal[::-1]})
+    filtered = nk.signal_filter(signals, highcut=10)
+    assert list(filtered.columns) == ["A", "B"]
+    assert np.allclose(filtered["B"], nk.signal_filter(signal[::-1], highcut=10))
+
+    # Channels as the rows of an array, filtered along the last axis
+    signals = np.vstack([signal, signal[::-1], 2 * signal])
+    for method in ["butterworth", "bessel", "butterworth_ba", "savgol", "powerline"]:
+        filtered = nk.signal_filter(signals, lowcut=1, highcut=10, method=method)
+        assert filtered.shape == (3, 1000)
+        for i in range(3):
+            assert np.allclose(filtered[i], nk.signal_filter(signals[i], lowcut=1, highcut=10, method=method))
 
     # Generate 10 seconds of signal with 2 Hz oscillation and added 50Hz powerline-noise.
     sampling_rate = 250
@@ -123,6 +147,46 @@ def test_signal_filter():
     assert np.allclose(sum(signal_clean * 100 - signal), -2, atol=0.2)    # multiply by 100 to compensate amplitude dampening
 
 
+def test_signal_filter_parallel(monkeypatch):
+
+    # Large multi-channel signals are filtered in blocks of channels (one per CPU)
+    monkeypatch.setattr("os.cpu_count", lambda: 3)
+    signals = np.random.RandomState(0).normal(size=(5, 2 ** 18))
+    filtered = nk.signal_filter(signals, lowcut=1, highcut=40, order=5)
+    assert filtered.shape == signals.shape
+    for i in range(5):
+        assert np.allclose(filtered[i], nk.signal_filter(signals[i], lowcut=1, highcut=40, order=5))
+
+
+def test_signal_filter_padding():
+
+    # Signals of up to 10 seconds are padded by at most a quarter of their length
+    sos = scipy.signal.butter(5, [1, 40], btype="bandpass", output="sos", fs=1000)
+    signal = np.random.RandomState(0).normal(size=30)  # Shorter than the default padding (33)
+    filtered = nk.signal_filter(signal, sampling_rate=1000, lowcut=1, highcut=40, order=5)
+    assert np.allclose(filtered, scipy.signal.sosfiltfilt(sos, signal, padlen=30 // 4))
+
+    # Longer signals are filtered as with scipy's default padding
+    signal = np.random.RandomState(0).normal(size=12000)
+    filtered = nk.signal_filter(signal, sampling_rate=1000, lowcut=1, highcut=40, order=5)
+    assert np.allclose(filtered, scipy.signal.sosfiltfilt(sos, signal), atol=1e-12)
+
+
+def test_signal_filter_nyquist(capsys):
+
+    # The warning is also shown for float cutoffs (the filter design then fails)
+    with pytest.raises(ValueError):
+        nk.signal_filter(np.random.rand(3000), sampling_rate=1000, highcut=500.0)
+    assert "the sampling rate is too low" in capsys.readouterr().out
+
+    nk.signal_filter(np.random.rand(3000), sampling_rate=1000, highcut=40.0)
+    assert "the sampling rate is too low" not in capsys.readouterr().out
+
+    # No cutoff left once the zeros are ignored
+    with pytest.raises(ValueError, match="cannot both be 0"):
+        nk.signal_filter(np.random.rand(3000), sampling_rate=1000, lowcut=0)
+
+
 def test_signal_interpolate():
 
     x_axis = np.linspace(start=10, stop=30, num=10)